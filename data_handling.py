@@ -3,16 +3,109 @@ import time
 import numpy as np
 import yfinance as yf
 from datetime import datetime, timedelta
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
 import pandas as pd
+from fetch_pool import fetch_executor, MAX_FETCH_WORKERS
 
-mongo_uri = st.secrets["mongo_uri"]
-client = MongoClient(mongo_uri)
-db = client['StockIdea']
-prices_collection = db['historical_prices']
+@st.cache_resource
+def get_mongo_client():
+    """Cria o cliente do MongoDB uma única vez por processo e o reutiliza entre sessões e reruns"""
+    return MongoClient(st.secrets["mongo_uri"], maxPoolSize=50)
+
+def get_database():
+    return get_mongo_client()['StockIdea']
+
+def get_prices_collection():
+    return get_database()['historical_prices']
+
+def setup_indexes():
+    """Configura índices usados pelas consultas da aplicação"""
+    # Consultas de preço filtram por ticker e intervalo de datas
+    get_prices_collection().create_index([
+        ('ticker', ASCENDING),
+        ('date', ASCENDING)
+    ], unique=True)
+    # Transações são sempre buscadas por usuário e ordenadas por data
+    get_database()['transactions'].create_index([
+        ('user_id', ASCENDING),
+        ('Date', ASCENDING)
+    ])
+
+# Quantidade de documentos convertidos por lote na migração das datas
+MIGRATION_BATCH_SIZE = 1000
+
+def migrate_string_dates():
+    """Converte uma única vez as datas gravadas como texto 'YYYY-MM-DD' para datas nativas do BSON"""
+    # As consultas usam limites datetime; documentos com data em texto não seriam encontrados
+    migrations = get_database()['migrations']
+    if migrations.find_one({'_id': 'historical_prices_bson_dates'}):
+        return
+
+    prices = get_prices_collection()
+    last_id = None
+    while True:
+        # Paginação por _id: documentos que não puderem ser convertidos não são relidos
+        query = {'date': {'$type': 'string'}}
+        if last_id is not None:
+            query['_id'] = {'$gt': last_id}
+        batch = list(prices.find(query, {'date': 1}).sort('_id', ASCENDING).limit(MIGRATION_BATCH_SIZE))
+        if not batch:
+            break
+        last_id = batch[-1]['_id']
+
+        try:
+            prices.bulk_write([
+                UpdateOne({'_id': doc['_id']}, {'$set': {'date': datetime.strptime(doc['date'], '%Y-%m-%d')}})
+                for doc in batch
+            ], ordered=False)
+        except BulkWriteError as e:
+            # Conflito no índice único: o ETL já regravou o dia com data nativa. A cópia em texto
+            # fica como está (nenhum dado é apagado) e apenas deixa de ser encontrada pelas consultas
+            if any(error['code'] != 11000 for error in e.details['writeErrors']):
+                raise
+
+    migrations.update_one(
+        {'_id': 'historical_prices_bson_dates'},
+        {'$set': {'completed_at': datetime.now()}},
+        upsert=True
+    )
+
+@st.cache_resource
+def init_database():
+    """Prepara o banco uma única vez por processo: índices e migração das datas antigas"""
+    setup_indexes()
+    migrate_string_dates()
+
+# Funções com cache diário seguem o mesmo padrão: em caso de falha a função privada com cache
+# levanta a exceção (exceções não são cacheadas) e o valor de fallback é montado na função pública,
+# para que um erro transitório não fique gravado até o cache expirar.
+
+class IncompleteDownloadError(Exception):
+    """Download do Yahoo em que algum ticker veio sem dados; carrega o resultado parcial"""
+    def __init__(self, data, failed_tickers):
+        super().__init__(f"Sem dados para: {', '.join(failed_tickers)}")
+        self.data = data
+        self.failed_tickers = failed_tickers
 
-@st.cache_data(ttl=3600)
 def get_fundamental_data(ticker, max_retries=3):
+    try:
+        return _get_fundamental_data(ticker, max_retries)
+    except Exception as e:
+        st.warning(f"Não foi possível obter dados para {ticker}. Erro: {e}")
+        return {
+            'P/L': np.nan,
+            'P/VP': np.nan,
+            'ROE': np.nan,
+            'Volume': np.nan,
+            'Price': np.nan,
+            'ROIC': np.nan,
+            'Dividend Yield': np.nan,
+            'Debt to Equity': np.nan
+        }
+
+@st.cache_data(ttl=86400, max_entries=1000, show_spinner=False)
+def _get_fundamental_data(ticker, max_retries=3):
     for attempt in range(max_retries):
         try:
             stock = yf.Ticker(ticker)
@@ -47,39 +140,86 @@ def get_fundamental_data(ticker, max_retries=3):
                 'Dividend Yield': info.get('trailingAnnualDividendYield', np.nan),
                 'Debt to Equity': info.get('debtToEquity', np.nan)
             }
-        except Exception as e:
+        except Exception:
             if attempt < max_retries - 1:
                 time.sleep(2 ** attempt)  # Exponential backoff
             else:
-                st.warning(f"Não foi possível obter dados para {ticker}. Erro: {e}")
-                return {
-                    'P/L': np.nan,
-                    'P/VP': np.nan,
-                    'ROE': np.nan,
-                    'Volume': np.nan,
-                    'Price': np.nan,
-                    'ROIC': np.nan,
-                    'Dividend Yield': np.nan,
-                    'Debt to Equity': np.nan
-                }
+                raise
+
+def _fetch_many(fetch, tickers, max_workers=MAX_FETCH_WORKERS):
+    """Run a per-ticker fetch function concurrently and return its results keyed by ticker"""
+    tickers = list(tickers)
+    with fetch_executor(max_workers) as executor:
+        return dict(zip(tickers, executor.map(fetch, tickers)))
+
+def get_fundamental_data_many(tickers):
+    return _fetch_many(get_fundamental_data, tickers)
                 
-@st.cache_data(ttl=3600)
 def get_stock_data(tickers, years=5, max_retries=3):
+    # Ordena os tickers para que a ordem da lista não invalide o cache
+    if not isinstance(tickers, str):
+        tickers = tuple(sorted(tickers))
+    try:
+        return _get_stock_data(tickers, years, max_retries)
+    except ConnectionError as e:
+        st.error(f"Erro ao obter dados históricos. Possível limite de requisição atingido. Erro: {e}")
+        return pd.DataFrame()
+    except IncompleteDownloadError as e:
+        # O resultado parcial é usado nesta execução, mas não fica em cache
+        if e.data.empty:
+            st.error(f"Erro ao obter dados históricos. Possível limite de requisição atingido. Erro: {e}")
+        else:
+            st.warning(f"Dados históricos incompletos. {e}")
+        return e.data
+
+@st.cache_data(ttl=86400, max_entries=1000, show_spinner=False)
+def _get_stock_data(tickers, years=5, max_retries=3):
+    if not isinstance(tickers, str):
+        tickers = list(tickers)
     end_date = datetime.now()
     start_date = end_date - timedelta(days=years*365)
     
 
     for attempt in range(max_retries):
         try:
-            data = yf.download(tickers, start=start_date, end=end_date)['Close']
-            return data
-        except ConnectionError as e:
+            # Preços ajustados explicitamente: o padrão do yfinance muda entre versões
+            data = yf.download(tickers, start=start_date, end=end_date, auto_adjust=True)['Close']
+            break
+        except ConnectionError:
             if attempt < max_retries - 1:
                 time.sleep(2 ** attempt)  # Exponential backoff
             else:
-                st.error(f"Erro ao obter dados históricos. Possível limite de requisição atingido. Erro: {e}")
-                return pd.DataFrame()
+                raise
+
+    # O yfinance não levanta exceção quando um ticker falha: a coluna volta toda NaN
+    frame = data.to_frame(tickers) if isinstance(data, pd.Series) else data
+    requested = [tickers] if isinstance(tickers, str) else tickers
+    failed_tickers = [t for t in requested if t not in frame.columns or frame[t].isna().all()]
+    if frame.empty or failed_tickers:
+        raise IncompleteDownloadError(data, failed_tickers or requested)
+    return data
                 
+def get_current_prices(tickers):
+    """
+    Fetch the latest close price for several tickers with a single yfinance download
+    
+    Parameters:
+    tickers (list): Stock ticker symbols
+    
+    Returns:
+    pandas.Series: Last available close price indexed by ticker
+    """
+    # Ordena os tickers para que a ordem da lista não invalide o cache
+    return _get_current_prices(tuple(sorted(tickers)))
+
+@st.cache_data(ttl=900, show_spinner=False)
+def _get_current_prices(tickers):
+    tickers = list(tickers)
+    closes = yf.download(tickers, period='5d', auto_adjust=True, threads=True, progress=False)['Close']
+    if isinstance(closes, pd.Series):
+        closes = closes.to_frame(tickers[0])
+    return closes.ffill().iloc[-1]
+
 def get_historical_prices(ticker, start_date, end_date):
     """
     Fetch historical price data from MongoDB instead of yfinance
@@ -92,21 +232,17 @@ def get_historical_prices(ticker, start_date, end_date):
     Returns:
     pandas.DataFrame: DataFrame with date and adjusted close prices
     """
-    # Convert dates to string format matching MongoDB
-    start_date_str = start_date
-    end_date_str = end_date
-    
-    # Query MongoDB for historical prices
+    # Query MongoDB for historical prices (dates are stored as BSON dates)
     query = {
         'ticker': ticker,
         'date': {
-            '$gte': start_date_str,
-            '$lte': end_date_str
+            '$gte': pd.to_datetime(start_date).to_pydatetime(),
+            '$lte': pd.to_datetime(end_date).to_pydatetime()
         }
     }
     
     # Fetch data from MongoDB
-    cursor = prices_collection.find(
+    cursor = get_prices_collection().find(
         query,
         {'_id': 0, 'date': 1, 'Close': 1}
     )
@@ -117,7 +253,7 @@ def get_historical_prices(ticker, start_date, end_date):
     if df.empty:
         return df
         
-    # Convert date string to datetime
+    # Ensure datetime dtype
     df['date'] = pd.to_datetime(df['date'])
     
     # Sort by date
@@ -125,22 +261,64 @@ def get_historical_prices(ticker, start_date, end_date):
     
     
     return df
+
+def get_historical_prices_bulk(tickers, start_date, end_date):
+    """
+    Fetch historical close prices for several tickers from MongoDB in a single query
     
+    Parameters:
+    tickers (list): Stock ticker symbols
+    start_date (datetime): Start date for historical data
+    end_date (datetime): End date for historical data
     
-def get_financial_growth_data(ticker, years=5):
-    stock = yf.Ticker(ticker)
+    Returns:
+    pandas.DataFrame: DataFrame indexed by date with one close price column per ticker
+    """
+    query = {
+        'ticker': {'$in': list(tickers)},
+        'date': {
+            '$gte': pd.to_datetime(start_date).to_pydatetime(),
+            '$lte': pd.to_datetime(end_date).to_pydatetime()
+        }
+    }
+    
+    cursor = get_prices_collection().find(
+        query,
+        {'_id': 0, 'ticker': 1, 'date': 1, 'Close': 1}
+    )
     
-    # Obter dados financeiros anuais
+    df = pd.DataFrame(list(cursor))
+    
+    if df.empty:
+        return df
+    
+    df['date'] = pd.to_datetime(df['date'])
+    
+    # One column per ticker, aligned on date
+    prices = df.pivot(index='date', columns='ticker', values='Close').sort_index()
+    prices.columns.name = None
+    
+    return prices
+    
+    
+def get_financial_growth_data(ticker, years=5):
     try:
-        financials = stock.financials
-        balance_sheet = stock.balance_sheet
+        return _get_financial_growth_data(ticker, years)
     except Exception as e:
         print(f"Error fetching data for {ticker}: {e}")
         return None
+
+@st.cache_data(ttl=86400, max_entries=1000, show_spinner=False)
+def _get_financial_growth_data(ticker, years=5):
+    stock = yf.Ticker(ticker)
+    
+    # Obter dados financeiros anuais (erros de rede são levantados e não entram no cache)
+    financials = stock.financials
+    balance_sheet = stock.balance_sheet
     
+    # O Yahoo devolve tabelas vazias quando limita as requisições: também não é cacheado
     if financials.empty or balance_sheet.empty:
-        print(f"No financial data available for {ticker}.")
-        return None
+        raise LookupError(f"No financial data available for {ticker}.")
     
     try:
         # Verificar se há dados financeiros suficientes
@@ -185,3 +363,6 @@ def get_financial_growth_data(ticker, years=5):
         'income_growth': income_growth,
         'debt_stability': debt_stability
     }
+
+def get_financial_growth_data_many(tickers):
+    return _fetch_many(get_financial_growth_data, tickers)
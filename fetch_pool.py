@@ -0,0 +1,18 @@
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+# Número máximo de requisições simultâneas ao Yahoo Finance
+MAX_FETCH_WORKERS = 16
+
+def fetch_executor(max_workers=MAX_FETCH_WORKERS):
+    """
+    Thread pool for concurrent Yahoo Finance requests
+    
+    Worker threads inherit the Streamlit script context of the caller, so warnings
+    emitted by the fetch functions still reach the page.
+    """
+    return ThreadPoolExecutor(
+        max_workers=max_workers,
+        initializer=add_script_run_ctx,
+        initargs=(None, get_script_run_ctx())
+    )
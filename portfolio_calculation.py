@@ -3,8 +3,8 @@ import pandas as pd
 import yfinance as yf
 from datetime import datetime, timedelta
 from scipy.optimize import minimize
-from statsmodels.tsa.arima.model import ARIMA
 import streamlit as st
+from fetch_pool import fetch_executor, MAX_FETCH_WORKERS
 
 class FinancialAnalysis:
     def __init__(self, risk_free_rate=0.02):
@@ -20,37 +20,129 @@ class FinancialAnalysis:
             return (hist['Close'].iloc[-1] / hist['Close'].iloc[0]) - 1
         return None
 
+    def get_cumulative_returns(self, tickers, prices=None):
+        """Get 5-year cumulative returns for several tickers, reusing already downloaded close prices when given."""
+        tickers = list(tickers)
+        if prices is None:
+            end_date = datetime.now()
+            start_date = end_date - timedelta(days=5*365)
+            hist = yf.download(tickers, start=start_date, end=end_date, auto_adjust=True, threads=True, progress=False)
+            prices = hist['Close'] if not hist.empty else pd.DataFrame()
+        if isinstance(prices, pd.Series):
+            prices = prices.to_frame(tickers[0])
+
+        # O yfinance devolve uma coluna toda NaN para tickers que falharam: tratados como ausentes
+        available = set(prices.columns[prices.notna().any()])
+        missing_tickers = [t for t in tickers if t not in available]
+
+        # Primeiro e último preço válidos de cada coluna, de uma vez
+        closes = prices.reindex(columns=[t for t in tickers if t in available])
+        if closes.empty:
+            cumulative_returns = pd.Series(np.nan, index=tickers)
+        else:
+            cumulative_returns = (closes.ffill().iloc[-1] / closes.bfill().iloc[0] - 1).reindex(tickers)
+
+        # Fallback para o caminho por ativo (em paralelo) se o download em lote não trouxe o ticker
+        if missing_tickers:
+            with fetch_executor(min(len(missing_tickers), MAX_FETCH_WORKERS)) as executor:
+                cumulative_returns[missing_tickers] = list(executor.map(self.get_cumulative_return, missing_tickers))
+        return cumulative_returns.astype(float)
+
+    @staticmethod
+    def _returns_np(prices):
+        """Calculate simple returns as an ndarray, returning (dates, returns) with incomplete rows removed."""
+        # Um único passe em NumPy: retornos simples, inf -> NaN e remoção das linhas incompletas
+        values = prices.ffill().to_numpy(dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            returns = values[1:] / values[:-1] - 1
+        returns[~np.isfinite(returns)] = np.nan
+        valid_rows = ~np.isnan(returns).any(axis=1)
+        return prices.index[1:][valid_rows], returns[valid_rows]
+
     def calculate_returns(self, prices):
         """Calculate returns from price data."""
         if prices.empty:
             return pd.DataFrame()
-        returns = prices.pct_change().dropna()
-        return returns.replace([np.inf, -np.inf], np.nan).dropna()
+        dates, returns = self._returns_np(prices)
+        return pd.DataFrame(returns, index=dates, columns=prices.columns)
+
+    @staticmethod
+    def _annualized_moments(returns):
+        """Annualized mean vector and covariance matrix as NumPy arrays."""
+        values = returns.to_numpy(dtype=float)
+        return values.mean(axis=0) * 252, np.cov(values, rowvar=False) * 252
+
+    @staticmethod
+    def portfolio_performance_np(weights, mu, sigma):
+        """Calculate portfolio return and volatility from precomputed annualized moments."""
+        return weights @ mu, np.sqrt(weights @ sigma @ weights)
 
     def portfolio_performance(self, weights, returns):
         """Calculate portfolio return and volatility."""
-        portfolio_return = np.sum(returns.mean() * weights) * 252
-        portfolio_volatility = np.sqrt(np.dot(weights.T, np.dot(returns.cov() * 252, weights)))
-        return portfolio_return, portfolio_volatility
+        mu, sigma = self._annualized_moments(returns)
+        return self.portfolio_performance_np(np.asarray(weights), mu, sigma)
 
     def negative_sharpe_ratio(self, weights, returns):
         """Calculate negative Sharpe ratio for optimization."""
         p_return, p_volatility = self.portfolio_performance(weights, returns)
         return -(p_return - self.risk_free_rate) / p_volatility
 
+    def make_neg_sharpe(self, mu, sigma):
+        """Build the negative Sharpe ratio objective, returning value and gradient, from precomputed annualized moments."""
+        # Média e covariância anualizadas são constantes durante a otimização e ficam capturadas no closure
+        risk_free_rate = self.risk_free_rate
+
+        def neg_sharpe_and_grad(weights):
+            # Sigma w é reaproveitado pela volatilidade e pelo gradiente
+            sigma_w = sigma @ weights
+            p_volatility = np.sqrt(weights @ sigma_w)
+            excess_return = weights @ mu - risk_free_rate
+            # d(-S)/dw = -mu/vol + (ret - rf) * Sigma w / vol^3
+            gradient = -mu / p_volatility + excess_return * sigma_w / p_volatility**3
+            return -excess_return / p_volatility, gradient
+
+        return neg_sharpe_and_grad
+
+    def _tangency_direction(self, mu, sigma):
+        """Unnormalized tangency portfolio Σ⁻¹ (μ - rf), or None when it cannot be computed."""
+        try:
+            # Uma única resolução de sistema linear
+            z = np.linalg.solve(sigma, mu - self.risk_free_rate)
+        except np.linalg.LinAlgError:
+            return None
+        return z if np.all(np.isfinite(z)) else None
+
+    @staticmethod
+    def _initial_weights(tangency, num_assets):
+        """Starting point for SLSQP: the clipped tangency portfolio, or equal weights."""
+        # Parte long-only da carteira tangente, normalmente próxima do ótimo com restrições
+        if tangency is not None:
+            clipped = np.clip(tangency, 0, None)
+            if clipped.sum() > 0:
+                return clipped / clipped.sum()
+        return np.full(num_assets, 1. / num_assets)
+
     def optimize_portfolio(self, returns):
         """Optimize portfolio weights using Sharpe ratio."""
         num_assets = returns.shape[1]
-        args = (returns,)
-        constraints = ({'type': 'eq', 'fun': lambda x: np.sum(x) - 1})
+        mu, sigma = self._annualized_moments(returns)
+        tangency = self._tangency_direction(mu, sigma)
+
+        # Se a carteira tangente já é long-only, ela é o ótimo exato e o SLSQP é dispensável
+        if tangency is not None and tangency.sum() > 0 and np.all(tangency >= 0):
+            return tangency / tangency.sum()
+
+        objective = self.make_neg_sharpe(mu, sigma)
+
+        constraints = ({'type': 'eq', 'fun': lambda x: np.sum(x) - 1, 'jac': lambda x: np.ones_like(x)})
         bound = (0.0, 1.0)
         bounds = tuple(bound for _ in range(num_assets))
         
         result = minimize(
-            self.negative_sharpe_ratio,
-            num_assets*[1./num_assets],
-            args=args,
+            objective,
+            self._initial_weights(tangency, num_assets),
             method='SLSQP',
+            jac=True,
             bounds=bounds,
             constraints=constraints
         )
@@ -58,94 +150,108 @@ class FinancialAnalysis:
 
     def generate_random_portfolios(self, returns, num_portfolios=5000):
         """Generate random portfolio allocations."""
-        results = []
         n_assets = returns.shape[1]
-        
-        for _ in range(num_portfolios):
-            weights = np.random.random(n_assets)
-            weights /= np.sum(weights)
-            p_return, p_volatility = self.portfolio_performance(weights, returns)
-            results.append({
-                'Return': p_return,
-                'Volatility': p_volatility,
-                'Sharpe': (p_return - self.risk_free_rate) / p_volatility,
-                'Weights': weights
-            })
-        return pd.DataFrame(results)
+        mu, sigma = self._annualized_moments(returns)
+
+        # Todas as carteiras de uma vez, uniformes sobre o simplex
+        weights = np.random.dirichlet(np.ones(n_assets), size=num_portfolios)
+        p_returns = weights @ mu
+        # w' Σ w para todas as carteiras via um único GEMM, sem temporários (P, N, N)
+        p_volatilities = np.sqrt(np.sum((weights @ sigma) * weights, axis=1))
+
+        return pd.DataFrame({
+            'Return': p_returns,
+            'Volatility': p_volatilities,
+            'Sharpe': (p_returns - self.risk_free_rate) / p_volatilities,
+            'Weights': list(weights)
+        })
 
     def detect_price_anomalies(self, prices, window=20, threshold=2):
-        """Detect price anomalies using ARIMA model."""
-        returns = prices.pct_change().dropna()
-        model = ARIMA(returns, order=(1,1,1))
-        results = model.fit()
-        residuals = results.resid
-        mean = residuals.rolling(window=window).mean()
-        std = residuals.rolling(window=window).std()
-        z_scores = (residuals - mean) / std
-        return abs(z_scores) > threshold
+        """Detect price anomalies using a rolling z-score of returns."""
+        returns = prices.pct_change()
+        mean = returns.rolling(window=window).mean()
+        std = returns.rolling(window=window).std()
+        z_scores = (returns - mean) / std
+        # Períodos sem retorno (antes da listagem) ficam como NaN e não entram na média
+        return (z_scores.abs() > threshold).astype(float).where(returns.notna())
+
+    @staticmethod
+    def _wilder_average(values, window):
+        """Wilder's moving average, seeded with the simple mean of the first window observations."""
+        sma = values.rolling(window=window).mean()
+        started = sma.notna().cumsum()
+        # Semente na primeira média simples completa de cada coluna; antes dela não há média
+        is_seed = sma.notna() & (started == 1)
+        seeded = values.where(started > 0).mask(is_seed, sma)
+        # A partir da semente: avg[t] = ((window - 1) * avg[t-1] + x[t]) / window
+        return seeded.ewm(alpha=1/window, adjust=False).mean()
 
     def calculate_rsi(self, prices, window=14):
-        """Calculate Relative Strength Index."""
+        """Calculate Relative Strength Index using Wilder's smoothing."""
         delta = prices.diff()
-        gain = (delta.where(delta > 0, 0)).rolling(window=window).mean()
-        loss = (-delta.where(delta < 0, 0)).rolling(window=window).mean()
+        gain = self._wilder_average(delta.clip(lower=0), window)
+        loss = self._wilder_average((-delta).clip(lower=0), window)
         rs = gain / loss
         return 100 - (100 / (1 + rs))
 
+    @staticmethod
+    def _score_features(ativos_df):
+        """Build the (N, 7) matrix of raw score features, one row per asset."""
+        return np.column_stack([
+            ativos_df['ROE'] / ativos_df['P/L'],
+            1 / ativos_df['P/VP'],
+            np.log(ativos_df['Volume']),
+            ativos_df['revenue_growth'],
+            ativos_df['income_growth'],
+            ativos_df['debt_stability'],
+            ativos_df['Dividend Yield']
+        ]).astype(float)
+
     def calculate_scores(self, ativos_df):
         """Calculate individual scores for each metric."""
-        scores = np.zeros((7, len(ativos_df)))
-        
-        # Calculate individual scores
-        scores[0] = ativos_df['ROE'] / ativos_df['P/L']
-        scores[1] = 1 / ativos_df['P/VP']
-        scores[2] = np.log(ativos_df['Volume'])
-        scores[3] = ativos_df['revenue_growth']
-        scores[4] = ativos_df['income_growth']
-        scores[5] = ativos_df['debt_stability']
-        scores[6] = ativos_df['Dividend Yield']
+        scores = self._score_features(ativos_df).T
         
-        # Normalize scores
-        for i in range(scores.shape[0]):
-            scores[i] = (scores[i] - np.min(scores[i])) / (np.max(scores[i]) - np.min(scores[i]))
-        
-        return scores
+        # Normalize scores (min-max por métrica)
+        min_scores = scores.min(axis=1, keepdims=True)
+        return (scores - min_scores) / (scores.max(axis=1, keepdims=True) - min_scores)
 
     def optimize_weights(self, ativos_df):
         """Optimize weights to maximize correlation between scores and returns."""
+        # Matriz de scores e alvo calculados uma única vez, fora da função objetivo
         scores = self.calculate_scores(ativos_df)
+        cumulative_returns = ativos_df['Rentabilidade Acumulada (5 anos)'].to_numpy(dtype=float)
         
+        # Componentes centrados: corr(s, y) = s_c · y_c / (|s_c| |y_c|)
+        centered_scores = scores - scores.mean(axis=1, keepdims=True)
+        centered_returns = cumulative_returns - cumulative_returns.mean()
+        returns_norm = np.linalg.norm(centered_returns)
+
         def objective(weights):
-            weighted_scores = np.sum(scores * weights.reshape(-1, 1), axis=0)
-            correlation = np.corrcoef(weighted_scores, ativos_df['Rentabilidade Acumulada (5 anos)'])[0, 1]
-            return -correlation
+            s_c = weights @ centered_scores
+            s_norm = np.linalg.norm(s_c)
+            correlation = (s_c @ centered_returns) / (s_norm * returns_norm)
+            # d corr / ds = y_c / (|s_c| |y_c|) - corr * s_c / |s_c|^2, e ds/dw = scores
+            grad_s = centered_returns / (s_norm * returns_norm) - correlation * s_c / s_norm**2
+            return -correlation, -(centered_scores @ grad_s)
 
-        constraints = ({'type': 'eq', 'fun': lambda x: np.sum(x) - 1})
+        constraints = ({'type': 'eq', 'fun': lambda x: np.sum(x) - 1, 'jac': lambda x: np.ones_like(x)})
         bounds = [(0, 1) for _ in range(7)]
         initial_weights = np.array([1/7] * 7)
         
-        result = minimize(objective, initial_weights, method='SLSQP', bounds=bounds, constraints=constraints)
+        result = minimize(objective, initial_weights, method='SLSQP', jac=True, bounds=bounds, constraints=constraints)
         return result.x
 
-    def calculate_adjusted_score(self, row, optimized_weights):
-        """Calculate final adjusted score with quality factors and anomaly penalties."""
-        base_score = (
-            optimized_weights[0] * row['ROE'] / row['P/L'] +
-            optimized_weights[1] / row['P/VP'] +
-            optimized_weights[2] * np.log(row['Volume']) +
-            optimized_weights[3] * row['revenue_growth'] +
-            optimized_weights[4] * row['income_growth'] +
-            optimized_weights[5] * row['debt_stability'] +
-            optimized_weights[6] * row['Dividend Yield']
-        )
+    def calculate_adjusted_scores(self, ativos_df, optimized_weights):
+        """Calculate final adjusted scores for all assets at once."""
+        base_score = self._score_features(ativos_df) @ np.asarray(optimized_weights)
 
-        quality_factor = (row['ROE'] + row['ROIC']) / 2
+        quality_factor = ((ativos_df['ROE'] + ativos_df['ROIC']) / 2).to_numpy(dtype=float)
         adjusted_base_score = base_score * (1 + quality_factor * 0.1)
-        
-        anomaly_penalty = sum([row[col] for col in ['price_anomaly', 'rsi_anomaly']])
+
+        anomaly_penalty = ativos_df[['price_anomaly', 'rsi_anomaly']].to_numpy(dtype=float).sum(axis=1)
         final_score = adjusted_base_score * (1 - 0.05 * anomaly_penalty)
-        
-        return final_score
+
+        return pd.Series(final_score, index=ativos_df.index)
 
     def adjust_weights_for_anomalies(self, weights, anomaly_scores):
         """Adjust portfolio weights based on anomaly scores."""
@@ -154,4 +260,4 @@ class FinancialAnalysis:
 
     def calculate_anomaly_scores(self, returns):
         """Calculate anomaly scores for returns."""
-        return returns.apply(lambda x: self.detect_price_anomalies(x).mean())
+        return self.detect_price_anomalies(returns).mean()
@@ -1,13 +1,12 @@
 import pandas as pd
 import yfinance as yf
 from datetime import datetime, timedelta
-from pymongo import MongoClient, ASCENDING
+from pymongo import MongoClient, ASCENDING, UpdateOne
 from typing import List, Dict
 import logging
 import time
 import os
 from concurrent.futures import ThreadPoolExecutor
-from collections import Counter
 
 full = False
 
@@ -20,8 +19,7 @@ client = MongoClient(mongo_uri)
 db = client['StockIdea']
 prices_collection = db['historical_prices']
 
-transactions = db['transactions'].find()
-transactions_list =  list({transaction['Ticker'] for transaction in transactions})
+transactions_list = db['transactions'].distinct('Ticker')
 transactions_list.append('^BVSP')
 
 def setup_indexes():
@@ -31,6 +29,8 @@ def setup_indexes():
             ('date', ASCENDING)
         ], unique=True)
 
+# A conversão das datas antigas em texto para datas nativas é feita uma única vez pela aplicação
+# (data_handling.migrate_string_dates); este ETL já grava datas nativas
 setup_indexes()
 
 #daily update
@@ -49,9 +49,8 @@ for ativo in transactions_list:
 
       dados.columns = dados.columns.get_level_values(0)
 
-      dados['date'] = dados['Date'].dt.strftime("%Y-%m-%d")
-
-      dados = dados.drop('Date', axis=1)
+      # Datas nativas (BSON Date) ocupam menos espaço e permitem consultas por intervalo no índice
+      dados = dados.rename(columns={'Date': 'date'})
       
       # Adicionar campo de identificação do ativo
       dados["ticker"] = ativo
@@ -59,25 +58,27 @@ for ativo in transactions_list:
       # Converter para dicionários e salvar no MongoDB
       registros = dados.to_dict("records")
       
-      # Use update_one with upsert to handle existing documents
-      for registro in registros:
-          prices_collection.update_one(
+      # Upsert all documents in a single unordered bulk request
+      operacoes = [
+          UpdateOne(
               {"ticker": registro["ticker"], "date": registro["date"]},  # Filter for existing document
               {"$set": registro},  # Update the document if found
               upsert=True  # Insert a new document if not found
           )
+          for registro in registros
+      ]
+      prices_collection.bulk_write(operacoes, ordered=False)
       print(f"Dados de {ativo} salvos no MongoDB.")
 
 #historical update of new tickers
 
-historical_prices_db = db['historical_prices'].find()
-historical_prices_db_list = list({(prices['ticker'], prices['date']) for prices in historical_prices_db})
-
-# Extract all tickers from historical_prices_db_list
-all_tickers = [item[0] for item in historical_prices_db_list]
-
-# Count the occurrences of each ticker
-ticker_counts = Counter(all_tickers)
+# Count the stored days of each ticker on the server ((ticker, date) is unique)
+ticker_counts = {
+    item['_id']: item['count']
+    for item in prices_collection.aggregate([
+        {'$group': {'_id': '$ticker', 'count': {'$sum': 1}}}
+    ])
+}
 
 # Create the two lists
 old_tickers = [ticker for ticker, count in ticker_counts.items() if count > 2]
@@ -97,9 +98,8 @@ for ativo in new_tickers:
 
       dados.columns = dados.columns.get_level_values(0)
 
-      dados['date'] = dados['Date'].dt.strftime("%Y-%m-%d")
-
-      dados = dados.drop('Date', axis=1)
+      # Datas nativas (BSON Date) ocupam menos espaço e permitem consultas por intervalo no índice
+      dados = dados.rename(columns={'Date': 'date'})
       
       # Adicionar campo de identificação do ativo
       dados["ticker"] = ativo
@@ -107,11 +107,14 @@ for ativo in new_tickers:
       # Converter para dicionários e salvar no MongoDB
       registros = dados.to_dict("records")
       
-      # Use update_one with upsert to handle existing documents
-      for registro in registros:
-          prices_collection.update_one(
+      # Upsert all documents in a single unordered bulk request
+      operacoes = [
+          UpdateOne(
               {"ticker": registro["ticker"], "date": registro["date"]},  # Filter for existing document
               {"$set": registro},  # Update the document if found
               upsert=True  # Insert a new document if not found
           )
+          for registro in registros
+      ]
+      prices_collection.bulk_write(operacoes, ordered=False)
       print(f"Dados de {ativo} salvos no MongoDB.")
@@ -8,12 +8,10 @@ import plotly.express as px
 from plotly.subplots import make_subplots
 from datetime import datetime, timedelta
 from requests.exceptions import ConnectionError
-from statsmodels.tsa.arima.model import ARIMA
 import warnings
 import openai
 from tenacity import retry, stop_after_attempt, wait_random_exponential
 warnings.filterwarnings('ignore')
-from pymongo import MongoClient
 import logging
 import time
 import google.generativeai as genai
@@ -28,16 +26,18 @@ import logging
 from streamlit_cookies_manager import EncryptedCookieManager
 import uuid
 import pytz
-from data_handling import get_fundamental_data, get_stock_data, get_historical_prices, get_financial_growth_data
+from concurrent.futures import as_completed
+from data_handling import (get_fundamental_data, get_fundamental_data_many, get_stock_data, get_current_prices,
+                           get_historical_prices_bulk, get_financial_growth_data, get_financial_growth_data_many, get_database,
+                           init_database)
+from fetch_pool import fetch_executor
 from ai_features import PortfolioAnalyzer
 from portfolio_calculation import FinancialAnalysis
 
 financial_analyzer = FinancialAnalysis()
 
 # MongoDB Atlas connection
-mongo_uri = st.secrets["mongo_uri"]
-client = MongoClient(mongo_uri)
-db = client['StockIdea']
+db = get_database()
 collection = db['transactions']
 prices_collection = db['historical_prices']
 stocks_collection = db['stocks']
@@ -109,6 +109,13 @@ def register_page():
             users_collection.insert_one(user)
             st.success("Usuário registrado com sucesso! Faça login para continuar.")
 
+def to_yahoo_tickers(assets_df):
+    """
+    Retorna os tickers no formato do Yahoo Finance (sufixo .SA apenas para ativos do Brasil)
+    """
+    is_brazil = assets_df['country'].str.lower() == 'brazil'
+    return np.where(is_brazil, assets_df['symbol'] + '.SA', assets_df['symbol']).tolist()
+
 def load_assets():
     assets = pd.DataFrame(list(stocks_collection.find()))
     if '_id' in assets.columns:
@@ -131,6 +138,8 @@ def log_transaction(date, ticker, action, quantity, price, user_id):
         'user_id': user_id  # Adiciona user_id na transação
     }
     collection.insert_one(transaction)
+    # A carteira mudou: descarta o desempenho em cache
+    get_portfolio_performance.clear()
     st.success('Transação registrada com sucesso! Já estamos procurando informações dos seus ativos e em breve vamos atualizar os dados abaixo.')
 
 # Modificar as funções de compra e venda
@@ -139,9 +148,15 @@ def buy_stock(date, ticker, quantity, price, user_id):
 
 def sell_stock(date, ticker, quantity, price, user_id):
     log_transaction(date, ticker, 'SELL', quantity, price, user_id)
+
+# Reruns do Streamlit por outros widgets não refazem as consultas; o cache é limpo ao registrar transações
+@st.cache_data(ttl=600, show_spinner=False)
 def get_portfolio_performance(user_id):
     # Fetch transactions for specific user
-    transactions = pd.DataFrame(list(collection.find({'user_id': user_id})))
+    transactions = pd.DataFrame(list(collection.find(
+        {'user_id': user_id},
+        {'_id': 0, 'Date': 1, 'Ticker': 1, 'Action': 1, 'Quantity': 1, 'Price': 1}
+    )))
     
     if transactions.empty:
         return pd.DataFrame(), pd.Series()
@@ -150,14 +165,13 @@ def get_portfolio_performance(user_id):
     transactions['Date'] = pd.to_datetime(transactions['Date'])
     transactions = transactions.sort_values('Date')
     
-    # Group transactions by ticker to calculate final positions
-    portfolio_summary = transactions.groupby('Ticker').apply(
-        lambda group: pd.Series({
-            'Total_Quantity': group[group['Action'] == 'BUY']['Quantity'].sum() - 
-                              group[group['Action'] == 'SELL']['Quantity'].sum(),
-            'Total_Invested': (group[group['Action'] == 'BUY']['Quantity'] * group[group['Action'] == 'BUY']['Price']).sum() - 
-                              (group[group['Action'] == 'SELL']['Quantity'] * group[group['Action'] == 'SELL']['Price']).sum()
-        })
+    # Group transactions by ticker to calculate final positions (compras somam, vendas subtraem)
+    sign = transactions['Action'].map({'BUY': 1, 'SELL': -1}).fillna(0)
+    transactions['Signed_Quantity'] = sign * transactions['Quantity']
+    transactions['Signed_Value'] = transactions['Signed_Quantity'] * transactions['Price']
+    portfolio_summary = transactions.groupby('Ticker').agg(
+        Total_Quantity=('Signed_Quantity', 'sum'),
+        Total_Invested=('Signed_Value', 'sum')
     ).reset_index()
     
     # Filter out stocks with zero quantity
@@ -170,37 +184,29 @@ def get_portfolio_performance(user_id):
     end_date = end_date_raw.strftime('%Y-%m-%d')
     start_date = start_date_raw.strftime('%Y-%m-%d')
     
-    # Initialize daily_values with a date index
-    first_ticker = active_portfolio['Ticker'].iloc[0] if not active_portfolio.empty else None
-    if first_ticker:
-        try:
-            initial_prices = get_historical_prices(first_ticker, start_date, end_date)
-            daily_values = pd.DataFrame(index=initial_prices['date'])
-        except Exception as e:
-            print(f"Could not fetch initial prices for {first_ticker}: {e}")
-            return pd.DataFrame(), pd.Series()
-    else:
+    if active_portfolio.empty:
         return pd.DataFrame(), pd.Series()
     
-    # Iterate through active portfolio and add daily values for each stock
-    for _, stock in active_portfolio.iterrows():  # Removed the asterisk
-        ticker = stock['Ticker']
-        quantity = stock['Total_Quantity']
-        
-        try:
-            ticker_prices = get_historical_prices(ticker, start_date, end_date)
-            ticker_prices = ticker_prices.set_index('date')['Close']
-            ticker_prices = ticker_prices.dropna()
-            
-            daily_values[ticker] = ticker_prices * quantity
-        except Exception as e:
-            print(f"Could not fetch prices for {ticker}: {e}")
+    # Fetch prices for every active stock in a single query
+    try:
+        prices = get_historical_prices_bulk(active_portfolio['Ticker'], start_date, end_date)
+    except Exception as e:
+        print(f"Could not fetch prices for {active_portfolio['Ticker'].tolist()}: {e}")
+        return pd.DataFrame(), pd.Series()
+    
+    if prices.empty:
+        return pd.DataFrame(), pd.Series()
+    
+    # Daily value of each position (tickers without prices are left out)
+    quantities = active_portfolio.set_index('Ticker')['Total_Quantity']
+    daily_values = prices * quantities.reindex(prices.columns)
             
     daily_values = daily_values.dropna()  # Remove any rows with missing values
     invested_values = active_portfolio.set_index('Ticker')['Total_Invested']
     
     return daily_values, invested_values
 
+@st.cache_data(ttl=3600, show_spinner=False)
 def get_ibovespa_data(start_date, end_date):
     """
     Fetch Ibovespa historical data from MongoDB instead of yfinance
@@ -212,16 +218,12 @@ def get_ibovespa_data(start_date, end_date):
     Returns:
     pandas.Series: Series with Ibovespa returns
     """
-    # Convert dates to string format
-    start_date_str = start_date
-    end_date_str = end_date
-    
-    # Query MongoDB for Ibovespa data
+    # Query MongoDB for Ibovespa data (dates are stored as BSON dates)
     query = {
         'ticker': '^BVSP',
         'date': {
-            '$gte': start_date_str,
-            '$lte': end_date_str
+            '$gte': pd.to_datetime(start_date).to_pydatetime(),
+            '$lte': pd.to_datetime(end_date).to_pydatetime()
         }
     }
     
@@ -237,7 +239,7 @@ def get_ibovespa_data(start_date, end_date):
     if df.empty:
         return pd.Series()
         
-    # Convert date string to datetime
+    # Ensure datetime dtype
     df['date'] = pd.to_datetime(df['date'])
     
     
@@ -268,14 +270,16 @@ def calculate_optimal_contribution_with_genai(portfolio_data, invested_value, co
             "assets": []
         }
 
+        # Get current prices for all assets in a single request and fundamentals concurrently
+        current_prices = get_current_prices(portfolio_data.columns)
+        fundamental_data_by_ticker = get_fundamental_data_many(portfolio_data.columns)
+        growth_data_by_ticker = get_financial_growth_data_many(portfolio_data.columns)
+
         for ticker in portfolio_data.columns:
-            # Get current stock data
-            stock = yf.Ticker(ticker)
-            current_price = stock.history(period="1d")['Close'].iloc[-1]
+            current_price = current_prices[ticker]
             
-            # Get fundamental data
-            fundamental_data = get_fundamental_data(ticker)
-            growth_data = get_financial_growth_data(ticker)
+            fundamental_data = fundamental_data_by_ticker[ticker]
+            growth_data = growth_data_by_ticker[ticker]
             
             asset_data = {
                 "ticker": ticker,
@@ -339,31 +343,42 @@ def calculate_optimal_contribution_with_genai(portfolio_data, invested_value, co
         return f"Erro ao gerar recomendação: {e}"
 
 
+def get_asset_data(symbol, ticker_symbol):
+    """
+    Obtém os dados fundamentalistas e de crescimento de um ativo
+    """
+    data = get_fundamental_data(ticker_symbol)
+    growth_data = get_financial_growth_data(ticker_symbol)
+
+    if growth_data:
+        data.update(growth_data)
+
+    data['symbol'] = symbol  # Mantém o ticker original sem o sufixo
+    return data
+
 def allocate_portfolio_integer_shares(invest_value, prices, weights):
-    allocation = {}
-    remaining_value = invest_value
+    tickers = prices.index
+    price_values = prices.to_numpy(dtype=float)
+    # Pesos levemente negativos (ruído do SLSQP nos limites) ou NaN não compram ações
+    weights = np.asarray(weights, dtype=float)
+    weights = np.where(weights > 0, weights, 0.0)
     
-    # Ordenar os ativos por peso, do maior para o menor
-    sorted_assets = sorted(zip(weights, prices.index), reverse=True)
+    # Ordenar os ativos por peso, do maior para o menor; empates (ex.: pesos zero) por ticker decrescente
+    ticker_rank = np.argsort(np.argsort(np.asarray(tickers, dtype=str)))
+    order = np.lexsort((-ticker_rank, -weights))
     
-    for weight, ticker in sorted_assets:
-        price = prices[ticker]
-        target_value = invest_value * weight
-        shares = int(target_value / price)  # Arredonda para baixo para obter um número inteiro de ações
-        
-        if shares > 0 and price * shares <= remaining_value:
-            allocation[ticker] = shares
-            remaining_value -= price * shares
+    # Arredonda para baixo o valor alvo de cada ativo para obter um número inteiro de ações
+    shares = np.maximum(np.floor(invest_value * weights / price_values), 0).astype(int)
+    remaining_value = invest_value - shares @ price_values
     
     # Tenta alocar o valor restante em mais ações, se possível
-    for weight, ticker in sorted_assets:
-        price = prices[ticker]
-        if price <= remaining_value:
-            additional_shares = int(remaining_value / price)
-            if additional_shares > 0:
-                allocation[ticker] = allocation.get(ticker, 0) + additional_shares
-                remaining_value -= price * additional_shares
+    for i in order:
+        if price_values[i] <= remaining_value:
+            additional_shares = int(remaining_value / price_values[i])
+            shares[i] += additional_shares
+            remaining_value -= price_values[i] * additional_shares
     
+    allocation = {tickers[i]: int(shares[i]) for i in order if shares[i] > 0}
     return allocation, remaining_value
 
 # Configuração básica para logs
@@ -391,40 +406,40 @@ def get_asset_recommendations(top_ativos, tickers, stock_data, returns, risk_fre
 
         # Criação de resumos de ativos
         assets_start = time.time()
-        assets = []
-        for ticker in tickers:
-            ticker_start = time.time()
-            base_ticker = ticker.replace('.SA', '')
-            asset_data = top_ativos[top_ativos['symbol'] == base_ticker].iloc[0]
-            anomaly_data = anomaly_df[anomaly_df['symbol'] == ticker].iloc[0]
-            
-            stock = yf.Ticker(ticker)
-            current_price = stock.history(period="1d")['Close'].iloc[-1]
-            
-            assets.append({
-                "ticker": base_ticker,
-                "sector": asset_data['sector'],
-                "industry": asset_data['industry'],
-                "preco_atual": current_price,
+        # Uma única junção por ticker em vez de buscar cada ativo em top_ativos e anomaly_df
+        # (tickers segue a ordem das linhas de top_ativos)
+        asset_table = top_ativos.drop(columns=['price_anomaly', 'rsi_anomaly'], errors='ignore').assign(yahoo_ticker=list(tickers)).merge(
+            anomaly_df.rename(columns={'symbol': 'yahoo_ticker'}), on='yahoo_ticker'
+        )
+        asset_table['preco_atual'] = get_current_prices(tickers).reindex(asset_table['yahoo_ticker']).values
+        asset_table['returns_volatility'] = (returns.std() * np.sqrt(252)).reindex(asset_table['yahoo_ticker']).values
+
+        assets = [
+            {
+                "ticker": row['yahoo_ticker'].replace('.SA', ''),
+                "sector": row['sector'],
+                "industry": row['industry'],
+                "preco_atual": row['preco_atual'],
                 "fundamentals": {
-                    "pe_ratio": asset_data['P/L'],
-                    "pb_ratio": asset_data['P/VP'],
-                    "roe": asset_data['ROE'],
-                    "roic": asset_data['ROIC'],
-                    "dividend_yield": asset_data['Dividend Yield']
+                    "pe_ratio": row['P/L'],
+                    "pb_ratio": row['P/VP'],
+                    "roe": row['ROE'],
+                    "roic": row['ROIC'],
+                    "dividend_yield": row['Dividend Yield']
                 },
                 "growth": {
-                    "revenue": asset_data['revenue_growth'],
-                    "income": asset_data['income_growth'],
-                    "debt_stability": asset_data['debt_stability']
+                    "revenue": row['revenue_growth'],
+                    "income": row['income_growth'],
+                    "debt_stability": row['debt_stability']
                 },
                 "risk": {
-                    "price_anomalies": anomaly_data['price_anomaly'],
-                    "rsi_anomalies": anomaly_data['rsi_anomaly'],
-                    "returns_volatility": returns[ticker].std() * np.sqrt(252)
+                    "price_anomalies": row['price_anomaly'],
+                    "rsi_anomalies": row['rsi_anomaly'],
+                    "returns_volatility": row['returns_volatility']
                 }
-            })
-            logging.info(f"Ticker {ticker} processado em {time.time() - ticker_start:.2f} segundos.")
+            }
+            for row in asset_table.to_dict('records')
+        ]
 
         logging.info(f"Resumo de ativos criado em {time.time() - assets_start:.2f} segundos.")
 
@@ -483,7 +498,7 @@ def portfolio_tracking(user_id):
 
     # Get all assets
     assets_df = load_assets()
-    tickers = assets_df.apply(lambda row: row['symbol'] + '.SA' if row['country'].lower() == 'brazil' else row['symbol'], axis=1).tolist()
+    tickers = to_yahoo_tickers(assets_df)
     
     # Transaction input
     st.subheader('Registrar Transação')
@@ -519,30 +534,17 @@ def portfolio_tracking(user_id):
         col2.metric("Valor Atual da Carteira", mask_monetary_value(current_value, show_values))
         col3.metric("Retorno Total", f"{total_return:.2f}%")
 
-        # Calculate returns for each asset
-        asset_returns = {}
-        for ticker in portfolio_data.columns:
-            initial_value = invested_value[ticker]
-            current_value = portfolio_data[ticker].iloc[-1]
-            if initial_value > 0:
-                asset_return = ((current_value - initial_value) / initial_value) * 100
-                asset_returns[ticker] = {
-                    'return': asset_return,
-                    'current_value': current_value
-                }
-
-        # Sort assets by return
-        sorted_assets = sorted(asset_returns.items(), key=lambda x: x[1]['return'], reverse=True)
+        # Calculate returns for each asset, sorted by return
+        last_values = portfolio_data.iloc[-1]
+        initial_values = invested_value.reindex(last_values.index)
+        has_investment = initial_values > 0
+        asset_returns = ((last_values[has_investment] - initial_values[has_investment]) / initial_values[has_investment] * 100).sort_values(ascending=False)
+        tickers = asset_returns.index.tolist()
+        returns = asset_returns.to_numpy()
+        current_values = last_values.reindex(asset_returns.index).to_numpy()
 
         # Create bar chart for asset returns
         fig_asset_returns = go.Figure()
-        tickers = []
-        returns = []
-        current_values = []
-        for ticker, data in sorted_assets:
-            tickers.append(ticker)
-            returns.append(data['return'])
-            current_values.append(data['current_value'])
 
         # Modify the hover text based on show_values setting
         hover_text = [
@@ -568,19 +570,16 @@ def portfolio_tracking(user_id):
         st.plotly_chart(fig_asset_returns)
 
         # Calculate daily portfolio value
-        daily_portfolio_value = portfolio_data.sum(axis=1)
-
-        # Calculate daily returns
-        daily_returns = daily_portfolio_value.pct_change()
+        daily_portfolio_value = portfolio_data.to_numpy(dtype=float).sum(axis=1)
 
-        # Calculate cumulative returns
-        portfolio_cumulative_returns = (1 + daily_returns).cumprod() - 1
-        portfolio_cumulative_returns = portfolio_cumulative_returns * 100
+        # Calculate cumulative returns: o produto dos retornos diários é V[t] / V[0] - 1
+        cumulative_returns = (daily_portfolio_value / daily_portfolio_value[0] - 1) * 100
 
         # Ensure the final return matches the total return
-        portfolio_cumulative_returns = portfolio_cumulative_returns * (total_return / portfolio_cumulative_returns.iloc[-1])
+        cumulative_returns *= total_return / cumulative_returns[-1]
+        portfolio_cumulative_returns = pd.Series(cumulative_returns, index=portfolio_data.index)
 
-        # Get Ibovespa data
+        # Get Ibovespa data (datas como 'YYYY-MM-DD' para que a chave do cache seja estável)
         ibovespa_start_date = portfolio_data.index[0].strftime('%Y-%m-%d')
         ibovespa_end_date = portfolio_data.index[-1].strftime('%Y-%m-%d')
         ibov_return = get_ibovespa_data(ibovespa_start_date, ibovespa_end_date)
@@ -597,7 +596,7 @@ def portfolio_tracking(user_id):
         fig_returns.add_trace(go.Scatter(
             x=portfolio_cumulative_returns.index, 
             y=portfolio_cumulative_returns.values,
-            customdata=daily_portfolio_value.values,
+            customdata=daily_portfolio_value,
             mode='lines', 
             name='Carteira',
             hovertemplate=portfolio_hover
@@ -626,19 +625,28 @@ def portfolio_tracking(user_id):
     st.subheader('Aporte Inteligente na Carteira')
     contribution_amount = st.number_input('Valor do Aporte (R$)', min_value=0.01, value=1000.00, step=0.01)
 
+    # A recomendação vale para este aporte e esta carteira; mudar outros widgets não a descarta
+    contribution_key = (
+        user_id,
+        contribution_amount,
+        None if portfolio_data.empty else (portfolio_data.index[-1], float(invested_value.sum()))
+    )
+    recommendation = None
     if st.button('Calcular Distribuição Ótima do Aporte'):
-        portfolio_data, invested_value = get_portfolio_performance(user_id)
         if not portfolio_data.empty:
             with st.spinner('Gerando recomendação personalizada...'):
                 recommendation = calculate_optimal_contribution_with_genai(portfolio_data, invested_value, contribution_amount)
-                # Mask values in recommendation if needed
-                if not show_values:
-                    recommendation = re.sub(r'R\$ \d+[.,]\d+', 'R$ ****,**', recommendation)
-                st.markdown(recommendation)
+                st.session_state['contribution_recommendation'] = {'key': contribution_key, 'text': recommendation}
         else:
             st.write("Não há dados suficientes para calcular a distribuição do aporte.")
-    
-    portfolio_data, invested_value = get_portfolio_performance(user_id)
+    elif st.session_state.get('contribution_recommendation', {}).get('key') == contribution_key:
+        recommendation = st.session_state['contribution_recommendation']['text']
+
+    if recommendation is not None:
+        # Mask values in recommendation if needed
+        if not show_values:
+            recommendation = re.sub(r'R\$ \d+[.,]\d+', 'R$ ****,**', recommendation)
+        st.markdown(recommendation)
     
     if not portfolio_data.empty:
         # Botão para gerar análise
@@ -681,6 +689,9 @@ def get_ibovespa_ytd_return():
 
 
 def main():
+    # Índices e migrações rodam uma vez por processo, no início da aplicação
+    init_database()
+
     if "authenticated" in cookies and cookies["authenticated"] == "true":
         st.sidebar.success(f"Bem-vindo(a), {cookies['user_name']}!")
         
@@ -731,48 +742,42 @@ def main():
                 options=[todos_opcao] + sorted(ativos_df['industry'].unique())
             )
     
-            # Aplicar todos os filtros de uma vez
-            filtered_df = ativos_df.copy()
-    
-            if country_filter != todos_opcao:
-                filtered_df = filtered_df[filtered_df['country'] == country_filter]
-        
-            if type_filter != todos_opcao:
-                filtered_df = filtered_df[filtered_df['type'] == type_filter]
-        
-            if sector_filter != todos_opcao:
-                filtered_df = filtered_df[filtered_df['sector'] == sector_filter]
-        
-            if industry_filter != todos_opcao:
-                filtered_df = filtered_df[filtered_df['industry'] == industry_filter]
-        
+            # Aplicar todos os filtros de uma vez, com uma única máscara booleana
+            filters = {
+                'country': country_filter,
+                'type': type_filter,
+                'sector': sector_filter,
+                'industry': industry_filter
+            }
+            mask = np.ones(len(ativos_df), dtype=bool)
+            for column, value in filters.items():
+                if value != todos_opcao:
+                    mask &= (ativos_df[column] == value).to_numpy()
     
-            ativos_df = filtered_df
+            ativos_df = ativos_df[mask].copy()
     
            
             invest_value = st.number_input('Valor a ser investido (R$)', min_value=100.0, value=10000.0, step=100.0)
         
+            # Entradas que definem a recomendação; reruns com as mesmas entradas reaproveitam o resultado
+            recommendation_key = (country_filter, type_filter, sector_filter, industry_filter, invest_value, datetime.now().date())
+    
             if st.button('Gerar Recomendação'):
                 progress_bar = st.progress(0)
                 status_text = st.empty()
         
-                # Obter dados fundamentalistas
+                # Obter dados fundamentalistas em paralelo (requisições de rede independentes)
+                ticker_symbols = to_yahoo_tickers(ativos_df)
                 fundamental_data = []
-                for i, ticker in enumerate(ativos_df['symbol']):
-                    status_text.text(f'Carregando dados para {ticker}...')
-                    progress_bar.progress((i + 1) / len(ativos_df))
-                    
-                    # Adiciona o sufixo .SA apenas se o país for Brazil
-                    ticker_symbol = ticker + '.SA' if ativos_df.iloc[i]['country'].lower() == 'brazil' else ticker
-                    
-                    data = get_fundamental_data(ticker_symbol)
-                    growth_data = get_financial_growth_data(ticker_symbol)
-                    
-                    if growth_data:
-                        data.update(growth_data)
-                    
-                    data['symbol'] = ticker  # Mantém o ticker original sem o sufixo
-                    fundamental_data.append(data)
+                with fetch_executor() as executor:
+                    futures = {
+                        executor.submit(get_asset_data, symbol, ticker_symbol): symbol
+                        for symbol, ticker_symbol in zip(ativos_df['symbol'], ticker_symbols)
+                    }
+                    for i, future in enumerate(as_completed(futures)):
+                        status_text.text(f'Carregando dados para {futures[future]}...')
+                        progress_bar.progress((i + 1) / len(futures))
+                        fundamental_data.append(future.result())
     
         
                 fundamental_df = pd.DataFrame(fundamental_data)
@@ -798,23 +803,26 @@ def main():
                     np.log(ativos_df['Volume'])
                 )
         
-                tickers_raw = ativos_df.apply(lambda row: row['symbol'] + '.SA' if row['country'].lower() == 'brazil' else row['symbol'], axis=1).tolist()
+                tickers_raw = to_yahoo_tickers(ativos_df)
             
                 
                 stock_data_raw = get_stock_data(tickers_raw)
         
-                # Detecção de anomalias e cálculo de RSI
-                for ticker in tickers_raw:
-                    price_anomalies = financial_analyzer.detect_price_anomalies(stock_data_raw[ticker])
-                    rsi = financial_analyzer.calculate_rsi(stock_data_raw[ticker])
-                    ativos_df.loc[ativos_df['symbol'] == ticker[:-3], 'price_anomaly'] = price_anomalies.mean()
-                    ativos_df.loc[ativos_df['symbol'] == ticker[:-3], 'rsi_anomaly'] = (rsi > 70).mean() + (rsi < 30).mean()
+                # Detecção de anomalias e cálculo de RSI para todos os ativos de uma vez
+                # (tickers_raw segue a ordem das linhas de ativos_df)
+                prices_raw = stock_data_raw[tickers_raw]
+                rsi_raw = financial_analyzer.calculate_rsi(prices_raw)
+                price_anomalies_raw = financial_analyzer.detect_price_anomalies(prices_raw).mean()
+                rsi_anomalies_raw = (rsi_raw > 70).mean() + (rsi_raw < 30).mean()
+                ativos_df['price_anomaly'] = price_anomalies_raw[tickers_raw].values
+                ativos_df['rsi_anomaly'] = rsi_anomalies_raw[tickers_raw].values
         
                 # Calcular score ajustado
-                cumulative_returns_raw = [financial_analyzer.get_cumulative_return(ticker) for ticker in tickers_raw]
-                ativos_df['Rentabilidade Acumulada (5 anos)'] = cumulative_returns_raw
+                # Reaproveita os preços de 5 anos já baixados em stock_data_raw
+                cumulative_returns_raw = financial_analyzer.get_cumulative_returns(tickers_raw, prices_raw)
+                ativos_df['Rentabilidade Acumulada (5 anos)'] = cumulative_returns_raw.values
                 optimized_weights = financial_analyzer.optimize_weights(ativos_df)
-                ativos_df['Adjusted_Score'] = ativos_df.apply(lambda row: financial_analyzer.calculate_adjusted_score(row, optimized_weights), axis=1)
+                ativos_df['Adjusted_Score'] = financial_analyzer.calculate_adjusted_scores(ativos_df, optimized_weights)
         
                 # Selecionar os top 10 ativos com base no score
                 top_ativos = ativos_df.nlargest(10, 'Adjusted_Score')
@@ -822,7 +830,7 @@ def main():
                 quality_data = top_ativos['ROIC'].values
     
         
-                tickers = top_ativos.apply(lambda row: row['symbol'] + '.SA' if row['country'].lower() == 'brazil' else row['symbol'], axis=1).tolist()
+                tickers = to_yahoo_tickers(top_ativos)
                 status_text.text('Obtendo dados históricos...')
                 stock_data = get_stock_data(tickers)
         
@@ -833,19 +841,8 @@ def main():
         
         
                 st.subheader('Top 10 BDRs Recomendados')
-                st.dataframe(top_ativos[['symbol', 'sector','industry', 'P/L', 'P/VP', 'ROE', 'ROIC', 'Dividend Yield','Volume', 'Price', 'Score', 'Adjusted_Score','revenue_growth','income_growth','debt_stability','Rentabilidade Acumulada (5 anos)']])
-        
-                # Otimização de portfólio
-                returns = financial_analyzer.calculate_returns(stock_data)
-        
-                # Verificar se há retornos válidos para continuar
-                if returns.empty:
-                    st.error("Não foi possível calcular os retornos dos ativos. Por favor, tente novamente mais tarde.")
-                    return
-        
-                # Calcular rentabilidade acumulada
-                cumulative_returns = [financial_analyzer.get_cumulative_return(ticker) for ticker in tickers]
-                top_ativos['Rentabilidade Acumulada (5 anos)'] = cumulative_returns
+                top_ativos_table = top_ativos[['symbol', 'sector','industry', 'P/L', 'P/VP', 'ROE', 'ROIC', 'Dividend Yield','Volume', 'Price', 'Score', 'Adjusted_Score','revenue_growth','income_growth','debt_stability','Rentabilidade Acumulada (5 anos)']]
+                st.dataframe(top_ativos_table)
         
                 # Otimização de portfólio
                 returns = financial_analyzer.calculate_returns(stock_data)
@@ -871,23 +868,21 @@ def main():
     
                 # Exibir informações sobre anomalias detectadas
                 #st.subheader('Análise de Anomalias')
-                anomaly_data = []
-                for ticker in tickers:
-                    price_anomalies = financial_analyzer.detect_price_anomalies(stock_data[ticker])
-                    rsi = financial_analyzer.calculate_rsi(stock_data[ticker])
-                    rsi_anomalies = (rsi > 70) | (rsi < 30)
-                    anomaly_data.append({
-                        'symbol': ticker,
-                        'price_anomaly': round(price_anomalies.mean(),2),
-                        'rsi_anomaly': round(rsi_anomalies.mean(),2)
-                    })
-    
-                anomaly_df = pd.DataFrame(anomaly_data)
+                prices_top = stock_data[tickers]
+                rsi_top = financial_analyzer.calculate_rsi(prices_top)
+                price_anomalies_top = financial_analyzer.detect_price_anomalies(prices_top).mean()
+                rsi_anomalies_top = ((rsi_top > 70) | (rsi_top < 30)).mean()
+                anomaly_df = pd.DataFrame({
+                    'symbol': tickers,
+                    'price_anomaly': price_anomalies_top[tickers].round(2).values,
+                    'rsi_anomaly': rsi_anomalies_top[tickers].round(2).values
+                })
                
+                # Retorno e volatilidade calculados uma vez; o Sharpe é derivado deles em get_asset_recommendations
                 portfolio_return, portfolio_volatility = financial_analyzer.portfolio_performance(adjusted_weights, returns)
-                portfolio_sharpe = (portfolio_return - risk_free_rate) / portfolio_volatility
     
-                prices = top_ativos.set_index('symbol')['Price']
+                # Preços na mesma ordem das colunas de retornos, que é a ordem dos pesos otimizados
+                prices = pd.Series(top_ativos['Price'].values, index=tickers).reindex(returns.columns)
                 allocation, remaining_value = allocate_portfolio_integer_shares(invest_value, prices, adjusted_weights)
                 
     
@@ -905,7 +900,19 @@ def main():
                         invest_value
                     )
                     st.markdown(recommendation)
-            pass
+    
+                st.session_state['recommendation'] = {
+                    'key': recommendation_key,
+                    'top_ativos': top_ativos_table,
+                    'text': recommendation
+                }
+            elif st.session_state.get('recommendation', {}).get('key') == recommendation_key:
+                # Outro widget disparou o rerun: exibe a última recomendação sem refazer o pipeline
+                cached = st.session_state['recommendation']
+                st.subheader('Top 10 BDRs Recomendados')
+                st.dataframe(cached['top_ativos'])
+                st.subheader('Análise Detalhada da Recomendação')
+                st.markdown(cached['text'])
         
         elif page == 'Acompanhamento da Carteira':
             portfolio_tracking(user_id)
@@ -144,12 +144,7 @@ def get_stocks_investpy():
             stocks = investpy.get_stocks(country=country)
 
             # Adiciona informações básicas
-            for _, stock in stocks.iterrows():
-                stock_info = {
-                    'symbol': stock['symbol'],
-                    'country': country
-                }
-                usa_stocks.append(stock_info)
+            usa_stocks.extend(stocks[['symbol']].assign(country=country).to_dict('records'))
 
         except Exception as e:
             print(f"Erro ao obter ações do país {country}: {str(e)}")